@@ -12,22 +12,42 @@ Usage:
 from __future__ import annotations
 
 import argparse
+import codecs
 import csv
+import io
 import json
+import os
+import re
+from collections import defaultdict
 from dataclasses import dataclass
+from operator import itemgetter
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, Iterable, Iterator, List, Tuple, Optional
 
 EXPECTED_COLS = [
     "Symbol","Quantity","Last","$ Chg","% Chg","Bid","Ask","Volume",
     "$ Avg Cost","$ Day G/L","% Day G/L","$ Total G/L","% Total G/L",
     "Value","Basis","Day Range","52W Range","Earnings Date","Div Amt","Div Ex-Date"
 ]
+# Only these columns are consumed downstream, so rows are reduced to them at parse time.
+RAW_COLS = ("Symbol", "Quantity", "Last", "Value")
+_PICK_RAW_COLS = itemgetter(*(EXPECTED_COLS.index(c) for c in RAW_COLS))
+_PAD = [""] * len(EXPECTED_COLS)
 
 FOOTER_PREFIXES = (
     "Totals", "Disclosure", "The data and information", "For more information", "Brokerage services",
     "Both are Fidelity", "\"Both are Fidelity"
 )
+# Line-start anchors accept \n, \r\n and bare \r endings (the latter is what splitlines() allowed).
+# Matches the first footer line; lets us find the end of the data block with one scan.
+FOOTER_RE = re.compile(
+    b"(?<=[\r\n])(?:" + b"|".join(re.escape(p.encode("utf-8")) for p in FOOTER_PREFIXES) + b")"
+)
+_HEADER_RE = re.compile(rb"(?<=[\r\n])Symbol,")
+_EOL_RE = re.compile(rb"\r\n?|\n")
+
+# '## SYMBOL' headings (leading indentation and surrounding whitespace ignored).
+_HEADING_RE = re.compile(r"^[^\S\n]*## [^\S\n]*(.*?)\s*$", re.MULTILINE)
 
 def parse_thesis_sections(thesis_path: Path) -> set[str]:
     """
@@ -36,64 +56,63 @@ def parse_thesis_sections(thesis_path: Path) -> set[str]:
     if not thesis_path.exists():
         return set()
 
-    text = thesis_path.read_text(encoding="utf-8", errors="replace").splitlines()
-    symbols = set()
-    for ln in text:
-        ln = ln.strip()
-        if ln.startswith("## "):
-            sym = ln[3:].strip()
-            # Keep it simple: treat the whole heading as symbol/key
-            if sym:
-                symbols.add(sym)
-    return symbols
+    # Keep it simple: treat the whole heading as symbol/key
+    text = thesis_path.read_text(encoding="utf-8", errors="replace")
+    return {sym for sym in _HEADING_RE.findall(text) if sym}
+
+# Deletes currency/percent/thousands characters in one C-level pass.
+_CLEAN_TBL = str.maketrans("", "", "$%,")
 
 def _to_float(x: str) -> Optional[float]:
     s = (x or "").strip()
     if s in ("", "--"):
         return None
-    s = s.replace("$", "").replace("%", "").replace(",", "")
+    s = s.translate(_CLEAN_TBL)
     try:
         return float(s)
     except ValueError:
         return None
 
 def load_targets(path: Path) -> dict:
-    with path.open("r", encoding="utf-8") as f:
-        return json.load(f)
+    # json.loads accepts bytes directly (and detects a UTF-8 BOM), so skip the text-mode wrapper.
+    return json.loads(path.read_bytes())
 
-def read_fidelity_positions(csv_path: Path) -> List[dict]:
+def read_fidelity_positions(csv_path: Path) -> List[Tuple[str, str, str, str]]:
     """
     Fidelity exports often include a title block before the real header. We:
-    - scan for a line starting with 'Symbol,'
+    - find the first line starting with 'Symbol,'
     - read subsequent non-empty lines until a footer
-    - parse as CSV rows
+    - parse the data block as CSV rows in a single csv.reader pass
+    Each row is returned as a (Symbol, Quantity, Last, Value) tuple of raw strings.
     """
-    lines = csv_path.read_text(encoding="utf-8-sig", errors="replace").splitlines()
-    header_idx = None
-    for i, ln in enumerate(lines):
-        if ln.startswith("Symbol,"):
-            header_idx = i
-            break
-    if header_idx is None:
-        raise ValueError("Could not find header row starting with 'Symbol,' in the provided CSV.")
-
-    data_lines: List[str] = []
-    for ln in lines[header_idx + 1:]:
-        if not ln.strip():
+    # Header/footer detection runs on the raw bytes; only the data block is ever decoded.
+    buf = csv_path.read_bytes()
+    start = len(codecs.BOM_UTF8) if buf.startswith(codecs.BOM_UTF8) else 0
+    if buf.startswith(b"Symbol,", start):
+        header_off = start
+    else:
+        header = _HEADER_RE.search(buf, start)
+        if header is None:
+            raise ValueError("Could not find header row starting with 'Symbol,' in the provided CSV.")
+        header_off = header.start()
+    eol = _EOL_RE.search(buf, header_off)
+    data_off = eol.end() if eol else len(buf)
+    footer = FOOTER_RE.search(buf, data_off)
+    data_end = footer.start() if footer else len(buf)
+    data_text = buf[data_off:data_end].decode("utf-8", errors="replace")
+
+    # One reader over the decoded block keeps the per-row work inside the C parser and
+    # lets it split lines itself, so no per-line list is built; blank lines come back as [].
+    rows: List[Tuple[str, str, str, str]] = []
+    for parts in csv.reader(io.StringIO(data_text, newline="")):
+        if not parts or (len(parts) == 1 and not parts[0].strip()):
             continue
-        if ln.startswith(FOOTER_PREFIXES):
-            break
-        data_lines.append(ln)
-
-    rows: List[dict] = []
-    for ln in data_lines:
-        parts = next(csv.reader([ln]))
-        parts = (parts + [""] * len(EXPECTED_COLS))[:len(EXPECTED_COLS)]
-        row = dict(zip(EXPECTED_COLS, parts))
-        rows.append(row)
+        if len(parts) < len(EXPECTED_COLS):
+            parts += _PAD[len(parts):]
+        rows.append(_PICK_RAW_COLS(parts))
     return rows
 
-@dataclass
+@dataclass(slots=True)
 class Position:
     symbol: str
     qty: float
@@ -101,23 +120,28 @@ class Position:
     value: float
     bucket: str = "Unassigned"
 
-def normalize_positions(raw_rows: List[dict], targets: dict) -> List[Position]:
+def normalize_positions(raw_rows: List[Tuple[str, str, str, str]], targets: dict) -> List[Position]:
     alias_map: Dict[str, str] = targets.get("alias_map", {})
     cash_symbols = set(s.strip() for s in targets.get("cash_symbols", []))
+    # All-accounts exports repeat the same symbols; resolve each distinct one only once.
+    resolved: Dict[str, str] = {}
 
     positions: List[Position] = []
-    for r in raw_rows:
-        sym_raw = (r.get("Symbol") or "").strip()
+    for sym_raw, qty_raw, last_raw, value_raw in raw_rows:
+        sym_raw = sym_raw.strip()
         if not sym_raw:
             continue
 
-        sym = alias_map.get(sym_raw, sym_raw)
-        if sym_raw in cash_symbols or "cash" in sym_raw.lower():
-            sym = "CASH"
+        sym = resolved.get(sym_raw)
+        if sym is None:
+            sym = alias_map.get(sym_raw, sym_raw)
+            if sym_raw in cash_symbols or "cash" in sym_raw.lower():
+                sym = "CASH"
+            resolved[sym_raw] = sym
 
-        qty = _to_float(r.get("Quantity", "")) or 0.0
-        last = _to_float(r.get("Last", "")) or 0.0
-        value = _to_float(r.get("Value", ""))
+        qty = _to_float(qty_raw) or 0.0
+        last = _to_float(last_raw) or 0.0
+        value = _to_float(value_raw)
 
         if value is None:
             value = qty * last
@@ -125,43 +149,74 @@ def normalize_positions(raw_rows: List[dict], targets: dict) -> List[Position]:
         positions.append(Position(symbol=sym, qty=qty, last=last, value=value))
     return positions
 
-def build_target_maps(targets: dict) -> Tuple[Dict[str, Tuple[float,float]], Dict[str, Tuple[float,float]]]:
+def compile_targets(targets: dict) -> Tuple[Dict[str, Tuple[float,float]], Dict[str, Tuple[float,float]], Dict[str, str]]:
+    """
+    Walks targets["buckets"] once and returns (per_symbol_targets, per_bucket_targets, sym_to_bucket).
+    """
     per_symbol: Dict[str, Tuple[float,float]] = {}
     per_bucket: Dict[str, Tuple[float,float]] = {}
+    sym_to_bucket: Dict[str, str] = {}
     for bucket_name, bucket in targets["buckets"].items():
         per_bucket[bucket_name] = tuple(bucket["target_total_pct"])
         for sym, rng in bucket["positions"].items():
             per_symbol[sym] = tuple(rng)
-    return per_symbol, per_bucket
-
-def assign_buckets(positions: List[Position], targets: dict) -> None:
-    sym_to_bucket: Dict[str, str] = {}
-    for bucket_name, bucket in targets["buckets"].items():
-        for sym in bucket["positions"].keys():
             sym_to_bucket[sym] = bucket_name
-    for p in positions:
-        p.bucket = sym_to_bucket.get(p.symbol, "Unassigned")
+    return per_symbol, per_bucket, sym_to_bucket
 
 def pct(x: float) -> str:
     return f"{x:.2f}%"
 
+def pct_range(rng: Tuple[float,float]) -> str:
+    return f"{rng[0]:.0f}–{rng[1]:.0f}%"
+
+def md_table(headers: Tuple[str, ...], align: str, rows: Iterable[Tuple[str, ...]]) -> Iterator[str]:
+    """
+    Yields the lines of a Markdown table. `align` has one character per column: 'l' or 'r'.
+    """
+    yield "| " + " | ".join(headers) + " |"
+    yield "|" + "".join("---:|" if a == "r" else "---|" for a in align)
+    for row in rows:
+        yield "| " + " | ".join(row) + " |"
+
+# Keyed by (over hard cap, below range, above range); concentration wins, then ADD, then TRIM.
+_ACTIONS: Dict[Tuple[bool, bool, bool], str] = {
+    (True, False, False): "TRIM (concentration)",
+    (True, False, True): "TRIM (concentration)",
+    (True, True, False): "TRIM (concentration)",
+    (True, True, True): "TRIM (concentration)",
+    (False, True, False): "ADD",
+    (False, True, True): "ADD",
+    (False, False, True): "TRIM",
+    (False, False, False): "HOLD",
+}
+
 def action_for_position(actual_pct: float, target_rng: Tuple[float,float], hard_cap: float) -> str:
     lo, hi = target_rng
-    if actual_pct > hard_cap:
-        return "TRIM (concentration)"
+    return _ACTIONS[(actual_pct > hard_cap, actual_pct < lo, actual_pct > hi)]
+
+def bucket_status(actual_pct: float, target_rng: Tuple[float,float]) -> str:
+    lo, hi = target_rng
     if actual_pct < lo:
-        return "ADD"
+        return "UNDER"
     if actual_pct > hi:
-        return "TRIM"
-    return "HOLD"
+        return "OVER"
+    return "OK"
 
-def make_report(positions: List[Position], targets: dict, thesis_symbols: set[str] | None = None) -> str:
-    per_symbol_targets, per_bucket_targets = build_target_maps(targets)
-    assign_buckets(positions, targets)
+def iter_report(positions: List[Position], targets: dict, thesis_symbols: set[str] | None = None) -> Iterator[str]:
+    """
+    Yields the Markdown report one section at a time so it can be streamed straight to disk.
+    """
+    per_symbol_targets, per_bucket_targets, sym_to_bucket = compile_targets(targets)
 
     thesis_symbols = thesis_symbols or set()
 
-    total = sum(p.value for p in positions if p.value is not None)
+    # Single pass: assign buckets and accumulate portfolio and per-bucket totals together.
+    total = 0.0
+    bucket_totals: Dict[str, float] = defaultdict(float)
+    for p in positions:
+        p.bucket = sym_to_bucket.get(p.symbol, "Unassigned")
+        total += p.value
+        bucket_totals[p.bucket] += p.value
     if total <= 0:
         raise ValueError("Total portfolio value computed as 0. Check the CSV parsing.")
 
@@ -169,16 +224,9 @@ def make_report(positions: List[Position], targets: dict, thesis_symbols: set[st
     single_cap = float(hard_caps.get("single_position_pct", 12))
     spec_cap = float(hard_caps.get("speculation_bucket_pct", 10))
 
-    pos_rows = []
-    for p in positions:
-        ap = (p.value / total) * 100
-        tr = per_symbol_targets.get(p.symbol)
-        pos_rows.append((p, ap, tr))
-
-    bucket_totals: Dict[str, float] = {}
-    for p in positions:
-        bucket_totals[p.bucket] = bucket_totals.get(p.bucket, 0.0) + p.value
-    bucket_pcts = {b: (v/total)*100 for b, v in bucket_totals.items()}
+    inv = 100.0 / total
+    pos_rows = [(p, p.value * inv, per_symbol_targets.get(p.symbol)) for p in positions]
+    bucket_pcts = {b: v * inv for b, v in bucket_totals.items()}
 
     lines: List[str] = []
     lines.append(f"# Portfolio Report — {targets.get('strategy_name','Strategy')}")
@@ -188,39 +236,34 @@ def make_report(positions: List[Position], targets: dict, thesis_symbols: set[st
 
     lines.append("## Bucket summary")
     lines.append("")
-    lines.append("| Bucket | Actual % | Target % | Status |")
-    lines.append("|---|---:|---:|---|")
-    for bname, actual in sorted(bucket_pcts.items(), key=lambda x: x[1], reverse=True):
+    bucket_table: List[Tuple[str, ...]] = []
+    for bname, actual in sorted(bucket_pcts.items(), key=itemgetter(1), reverse=True):
         tr = per_bucket_targets.get(bname)
         if tr:
-            status = "OK" if (actual >= tr[0] and actual <= tr[1]) else ("UNDER" if actual < tr[0] else "OVER")
-            lines.append(f"| {bname} | {pct(actual)} | {tr[0]:.0f}–{tr[1]:.0f}% | {status} |")
+            bucket_table.append((bname, pct(actual), pct_range(tr), bucket_status(actual, tr)))
         else:
-            lines.append(f"| {bname} | {pct(actual)} | — | — |")
+            bucket_table.append((bname, pct(actual), "—", "—"))
+    lines.extend(md_table(("Bucket", "Actual %", "Target %", "Status"), "lrrl", bucket_table))
 
     if "Speculation" in bucket_pcts and bucket_pcts["Speculation"] > spec_cap + 1e-9:
         lines.append("")
         lines.append(f"**Alert:** Speculation bucket is {pct(bucket_pcts['Speculation'])} which is above the cap ({spec_cap:.0f}%).")
 
+    yield "\n".join(lines) + "\n"
+    lines.clear()
+
     # Thesis coverage
     lines.append("")
     lines.append("## Thesis coverage")
     lines.append("")
-    lines.append("| Symbol | Bucket | Thesis? |")
-    lines.append("|---|---|---|")
-
-    # Only check non-core + non-cash positions that are in targets
-    for p, actual, tr in pos_rows:
-        if p.bucket in ("Core", "Cash"):
-            continue
-        if tr is None:
-            # Not in targets: still helpful to have a thesis if you keep it
-            has = "✅" if p.symbol in thesis_symbols else "⚠️ missing"
-            lines.append(f"| {p.symbol} | {p.bucket} | {has} |")
-            continue
 
-        has = "✅" if p.symbol in thesis_symbols else "⚠️ missing"
-        lines.append(f"| {p.symbol} | {p.bucket} | {has} |")
+    # Only check non-core + non-cash positions; ones not in targets still benefit from a thesis
+    thesis_table = (
+        (p.symbol, p.bucket, "✅" if p.symbol in thesis_symbols else "⚠️ missing")
+        for p, _, _ in pos_rows
+        if p.bucket not in ("Core", "Cash")
+    )
+    lines.extend(md_table(("Symbol", "Bucket", "Thesis?"), "lll", thesis_table))
 
     missing = []
     for p, actual, tr in pos_rows:
@@ -233,19 +276,24 @@ def make_report(positions: List[Position], targets: dict, thesis_symbols: set[st
         lines.append("")
         lines.append("**Add thesis sections for:** " + ", ".join(sorted(set(missing))))
 
+    yield "\n".join(lines) + "\n"
+    lines.clear()
+
     lines.append("")
     lines.append("## Position actions")
     lines.append("")
-    lines.append("| Symbol | Bucket | Actual % | Target % | Action |")
-    lines.append("|---|---|---:|---:|---|")
 
-    pos_rows.sort(key=lambda t: t[1], reverse=True)
-    for p, actual, tr in pos_rows:
-        if tr is None:
-            lines.append(f"| {p.symbol} | {p.bucket} | {pct(actual)} | — | REVIEW (not in targets) |")
-            continue
-        action = action_for_position(actual, tr, single_cap)
-        lines.append(f"| {p.symbol} | {p.bucket} | {pct(actual)} | {tr[0]:.0f}–{tr[1]:.0f}% | {action} |")
+    # Sorted once (descending actual %); the priority pass below reuses this order as-is.
+    pos_rows.sort(key=itemgetter(1), reverse=True)
+    action_table = (
+        (p.symbol, p.bucket, pct(actual), "—", "REVIEW (not in targets)") if tr is None
+        else (p.symbol, p.bucket, pct(actual), pct_range(tr), action_for_position(actual, tr, single_cap))
+        for p, actual, tr in pos_rows
+    )
+    lines.extend(md_table(("Symbol", "Bucket", "Actual %", "Target %", "Action"), "llrrl", action_table))
+
+    yield "\n".join(lines) + "\n"
+    lines.clear()
 
     lines.append("")
     lines.append("## Priority list (what to do first)")
@@ -255,19 +303,23 @@ def make_report(positions: List[Position], targets: dict, thesis_symbols: set[st
     core_actual = bucket_pcts.get("Core", 0.0)
     core_target = per_bucket_targets.get("Core")
     if core_target and core_actual < core_target[0]:
-        priorities.append(f"- Build **Core**: currently {pct(core_actual)} vs target {core_target[0]:.0f}–{core_target[1]:.0f}%. Route new money and trims primarily to VTI/SCHD.")
-
-    for p, actual, tr in pos_rows:
-        if actual > single_cap + 1e-9:
-            priorities.append(f"- Reduce concentration: **{p.symbol}** is {pct(actual)} (cap {single_cap:.0f}%).")
-
-    for p, actual, tr in pos_rows:
-        if tr and actual > tr[1] + 1e-9 and actual <= single_cap + 1e-9:
-            priorities.append(f"- Consider trimming: **{p.symbol}** is {pct(actual)} vs target {tr[0]:.0f}–{tr[1]:.0f}%.")
+        priorities.append(f"- Build **Core**: currently {pct(core_actual)} vs target {pct_range(core_target)}. Route new money and trims primarily to VTI/SCHD.")
 
+    # One pass over pos_rows; an over-cap position can still be below its own target range.
+    single_cap_eps = single_cap + 1e-9
+    concentrated: List[str] = []
+    trims: List[str] = []
+    adds: List[str] = []
     for p, actual, tr in pos_rows:
+        if actual > single_cap_eps:
+            concentrated.append(f"- Reduce concentration: **{p.symbol}** is {pct(actual)} (cap {single_cap:.0f}%).")
+        elif tr and actual > tr[1] + 1e-9:
+            trims.append(f"- Consider trimming: **{p.symbol}** is {pct(actual)} vs target {pct_range(tr)}.")
         if tr and actual < tr[0] - 1e-9:
-            priorities.append(f"- Candidate to add: **{p.symbol}** is {pct(actual)} vs target {tr[0]:.0f}–{tr[1]:.0f}%.")
+            adds.append(f"- Candidate to add: **{p.symbol}** is {pct(actual)} vs target {pct_range(tr)}.")
+    priorities.extend(concentrated)
+    priorities.extend(trims)
+    priorities.extend(adds)
 
     if not priorities:
         priorities.append("- Portfolio is within target ranges. Maintain contributions and review monthly.")
@@ -277,7 +329,7 @@ def make_report(positions: List[Position], targets: dict, thesis_symbols: set[st
     lines.append("## Notes")
     lines.append("")
     lines.append("- This report is decision support, not an instruction to trade. You control execution and timing.")
-    return "\\n".join(lines)
+    yield "\n".join(lines) + "\n"
 
 def main() -> int:
     ap = argparse.ArgumentParser()
@@ -297,8 +349,16 @@ def main() -> int:
         thesis_symbols = parse_thesis_sections(Path(args.thesis))
     raw = read_fidelity_positions(csv_path)
     pos = normalize_positions(raw, targets)
-    report = make_report(pos, targets, thesis_symbols=thesis_symbols)
-    out_path.write_text(report, encoding="utf-8")
+    # Stream into a sibling temp file and swap it in only once the whole report has rendered,
+    # so an error in any section leaves an existing report untouched.
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    try:
+        with tmp_path.open("w", encoding="utf-8", buffering=1 << 20) as f:
+            f.writelines(iter_report(pos, targets, thesis_symbols=thesis_symbols))
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
     print(f"Wrote report to: {out_path}")
     return 0
 